@@ -1,16 +1,21 @@
 import asyncio
 import os 
-import pickle 
-import re 
+import time
+import msgspec
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import LRUCache
 from dotenv import load_dotenv 
-from typing import List, Dict, Union, Optional
+from joblib import load as joblib_load
+from typing import Any, Callable, List, Dict, Union, Optional
 
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel, Field
 
 from google.adk.agents import LlmAgent
 from google.adk.runners import Runner
-from google.adk.sessions import InMemorySessionService 
+from google.adk.sessions import InMemorySessionService, Session
 from google.genai import types 
 
 app = FastAPI(
@@ -25,24 +30,247 @@ if not os.getenv("GEMINI_API_KEY"):
 
 MODEL_FILE = 'model.pkl'
 loaded_model = None
+fast_predict: Optional[Callable[[np.ndarray], np.ndarray]] = None
 
 try:
-    with open(MODEL_FILE, 'rb') as file:
-        loaded_model = pickle.load(file)
+    # mmap_mode='r' memetakan array numpy di dalam model sehingga dibagi antar worker lewat page cache.
+    loaded_model = joblib_load(MODEL_FILE, mmap_mode='r')
     print(f"SUCCESS: Model '{MODEL_FILE}' berhasil dimuat.")
 except FileNotFoundError:
     print(f"ERROR: File '{MODEL_FILE}' tidak ditemukan. Model prediksi tidak akan berfungsi.")
 except Exception as e:
     print(f"ERROR saat memuat model: {e}. Pastikan Scikit-learn terinstal.")
 
+
+def _build_fast_predict(model) -> Optional[Callable[[np.ndarray], np.ndarray]]:
+    """
+    Membangun fungsi prediksi numpy murni untuk Pipeline PolynomialFeatures + LinearRegression.
+    Untuk batch kecil, validasi input scikit-learn lebih mahal daripada perhitungannya sendiri.
+    Mengembalikan None jika model tidak berbentuk pipeline tersebut.
+    """
+    from sklearn.linear_model import LinearRegression
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import PolynomialFeatures
+
+    if not isinstance(model, Pipeline) or len(model.steps) != 2:
+        return None
+    poly, linear = model.steps[0][1], model.steps[1][1]
+    if not isinstance(poly, PolynomialFeatures) or not isinstance(linear, LinearRegression):
+        return None
+
+    coef = np.asarray(linear.coef_, dtype=np.float64)
+    if coef.ndim != 1:
+        return None
+    powers = np.asarray(poly.powers_)
+    intercept = float(linear.intercept_)
+
+    def predict(features: np.ndarray) -> np.ndarray:
+        # Kolom fitur polinomial j = prod_i x_i ** powers[j, i], lalu kombinasi linear.
+        return np.prod(features[:, np.newaxis, :] ** powers, axis=2) @ coef + intercept
+
+    return predict
+
+
+if loaded_model is not None:
+    try:
+        # Batch prediksi kecil (4 skenario): paralelisme hanya menambah overhead.
+        n_jobs_params = {name: 1 for name in loaded_model.get_params() if name == 'n_jobs' or name.endswith('__n_jobs')}
+        if n_jobs_params:
+            loaded_model.set_params(**n_jobs_params)
+        # Prediksi pemanasan agar permintaan pertama tidak menanggung biaya inisialisasi.
+        loaded_model.predict(np.zeros((1, getattr(loaded_model, 'n_features_in_', 4)), dtype=np.float64))
+    except Exception as e:
+        print(f"WARNING: Pemanasan model gagal: {e}")
+
+    try:
+        fast_predict = _build_fast_predict(loaded_model)
+        if fast_predict is not None:
+            n_features = getattr(loaded_model, 'n_features_in_', 4)
+            probe = np.vstack([np.zeros(n_features), np.arange(1, n_features + 1)]).astype(np.float64)
+            if not np.allclose(fast_predict(probe), loaded_model.predict(probe)):
+                print("WARNING: Prediksi cepat tidak cocok dengan model, memakai predict scikit-learn.")
+                fast_predict = None
+    except Exception as e:
+        print(f"WARNING: Prediksi cepat tidak dapat dibangun: {e}")
+        fast_predict = None
+
+
+class BoundedSessionService(InMemorySessionService):
+    """InMemorySessionService dengan batas jumlah sesi (LRU) dan masa hidup sesi yang tidak aktif (TTL)."""
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 24 * 60 * 60):
+        super().__init__()
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._lru: OrderedDict = OrderedDict()
+
+    def _is_expired(self, key: tuple) -> bool:
+        last_used = self._lru.get(key)
+        return last_used is not None and time.monotonic() - last_used >= self._ttl
+
+    async def has_session(self, *, app_name: str, user_id: str, session_id: str) -> bool:
+        """
+        Cek keberadaan sesi tanpa memperbarui urutan LRU.
+        Sesi yang tidak aktif melewati TTL dihapus di sini dan dianggap tidak ada.
+        """
+        key = (app_name, user_id, session_id)
+        if key not in self._lru:
+            return False
+        if self._is_expired(key):
+            await self.delete_session(app_name=app_name, user_id=user_id, session_id=session_id)
+            return False
+        return True
+
+    def _touch(self, key: tuple) -> None:
+        self._lru[key] = time.monotonic()
+        self._lru.move_to_end(key)
+
+    async def _evict(self) -> None:
+        """Menghapus sesi paling lama tidak dipakai selama kapasitas terlampaui atau sesi sudah kedaluwarsa."""
+        now = time.monotonic()
+        while self._lru:
+            key, last_used = next(iter(self._lru.items()))
+            if len(self._lru) <= self._maxsize and now - last_used < self._ttl:
+                break
+            app_name, user_id, session_id = key
+            await self.delete_session(app_name=app_name, user_id=user_id, session_id=session_id)
+
+    async def create_session(
+        self,
+        *,
+        app_name: str,
+        user_id: str,
+        state: Optional[Dict[str, Any]] = None,
+        session_id: Optional[str] = None,
+    ) -> Session:
+        session = await super().create_session(
+            app_name=app_name, user_id=user_id, state=state, session_id=session_id
+        )
+        self._touch((app_name, user_id, session.id))
+        await self._evict()
+        return session
+
+    async def get_session(
+        self,
+        *,
+        app_name: str,
+        user_id: str,
+        session_id: str,
+        config: Optional[Any] = None,
+    ) -> Optional[Session]:
+        key = (app_name, user_id, session_id)
+        if self._is_expired(key):
+            await self.delete_session(app_name=app_name, user_id=user_id, session_id=session_id)
+            return None
+
+        session = await super().get_session(
+            app_name=app_name, user_id=user_id, session_id=session_id, config=config
+        )
+        if session is not None and key in self._lru:
+            self._touch(key)
+        return session
+
+    async def delete_session(self, *, app_name: str, user_id: str, session_id: str) -> None:
+        """Menghapus sesi; juga dipakai saat eviksi dan kedaluwarsa."""
+        await super().delete_session(app_name=app_name, user_id=user_id, session_id=session_id)
+        self._lru.pop((app_name, user_id, session_id), None)
+
+
 AGENT_NAME = "mining_prediction_agent"
 APP_NAME = "agents" 
 GEMINI_MODEL = "gemini-2.5-flash" 
-session_service = InMemorySessionService() 
+session_service = BoundedSessionService()
 mining_agent: Optional[LlmAgent] = None
+runner: Optional[Runner] = None
+_predict_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+_parse_cache: LRUCache = LRUCache(maxsize=2048)
+_MAX_OUTPUT_RETRIES = 1
+
+_END_ANALYSIS_TAG = '---END_ANALYSIS---'
+_RECOMMENDATION_TAG = '---START_RECOMMENDATION---'
+_ANALYSIS_KEYS = ('Target_Tonase_Ekstrak', 'Prediksi_Kontrol', 'Selisih_Kontrol')
+_REC_FIELDS = {
+    'Truk': ('trucks', lambda v: int(float(v))),
+    'Ekskavator': ('excavators', lambda v: int(float(v))),
+    'Operator': ('operators', lambda v: int(float(v))),
+    'Cuaca': ('weather', str),
+    'Prediksi': ('predicted_tonnage', float),
+    'Selisih': ('difference_from_target', float),
+    'Alasan': ('rationale', str),
+}
+
+
+class RecommendationDetail(BaseModel):
+    title: str = Field(..., description="Judul deskriptif rekomendasi.")
+    trucks: int
+    excavators: int
+    operators: int
+    weather: Union[int, str]
+    predicted_tonnage: float
+    difference_from_target: float
+    rationale: str = Field(..., description="Alasan kuat dan berbasis data mengapa skenario ini direkomendasikan.")
+
+class MiningInput(BaseModel):
+    """Schema untuk data yang dikirimkan: pesan teks bebas."""
+    user_id: str = Field(..., example="user_api_001", description="ID unik pengguna untuk sesi berlanjut.")
+    query: str = Field(..., min_length=1, max_length=2048, example="Saya ingin 80 ton. Saat ini pakai 12 Truk, 3 Ekskavator, 18 Operator, cuaca Cloudy. Beri 3 rekomendasi!", description="Pesan teks bebas yang berisi Target dan parameter tambang.")
+
+class ParsedRecommendationResponse(BaseModel):
+    """Schema untuk output yang sudah dipisah-pisah. Semua kolom penting WAJIB diisi."""
+    status: str = Field("success")
+    target_tonnage: int = Field(..., description="Target tonase yang diekstrak.") 
+    initial_analysis_text: str = Field(..., description="Analisis Agent mengenai Skenario Kontrol (Input Asli).")
+    initial_prediction: float = Field(..., description="Hasil prediksi tonase dari input asli.") 
+    initial_difference: float = Field(..., description="Selisih mutlak dari input asli ke target.") 
+    recommendations: List[RecommendationDetail] = Field(..., description="Daftar 3 skenario rekomendasi terbaik.")
+
+
+class _RecommendationStruct(msgspec.Struct):
+    """Cerminan RecommendationDetail untuk decoding JSON output Agent dengan msgspec."""
+    title: str
+    trucks: int
+    excavators: int
+    operators: int
+    weather: Union[int, str]
+    predicted_tonnage: float
+    difference_from_target: float
+    rationale: str
+
+class _AgentOutputStruct(msgspec.Struct, kw_only=True):
+    """Cerminan ParsedRecommendationResponse; decode + validasi JSON sekali jalan di C."""
+    status: str = "success"
+    target_tonnage: int
+    initial_analysis_text: str
+    initial_prediction: float
+    initial_difference: float
+    recommendations: List[_RecommendationStruct]
+
+_AGENT_OUTPUT_DECODER = msgspec.json.Decoder(_AgentOutputStruct, strict=False)
 
 
-def predict_mining_target(scenarios: List[List[Union[int, float]]]) -> str:
+_AGENT_INSTRUCTION = """
+    Anda adalah **Ahli Optimasi Sumber Daya Tambang** (Mining Data Analyst).
+
+    **Pemetaan Cuaca:** Light Rain=0, Cloudy=1, Sunny=2
+    
+    **ATURAN KONTEKS:**
+    1. Jika query baru adalah MODIFIKASI (misal: "tambah 2 truk"), Anda HARUS mengambil Target Tonase (TT), Truk (T), Ekskavator (E), Operator (O), dan Cuaca (C) dari riwayat percakapan terakhir dan menerapkan modifikasi tersebut.
+    2. Jika query baru memiliki SEMUA parameter, gunakan yang baru.
+
+    **Tugas Utama (Untuk Setiap Respon):**
+    1.  **Ekstrak/Tentukan** nilai: Target Tonase (TT), Truk (T), Ekskavator (E), Operator (O), dan Cuaca (C) dari query saat ini ATAU dari konteks yang dimodifikasi.
+    2.  Buat Skenario 1 (Kontrol: T, E, O, C) dan 3 Skenario modifikasi (S2, S3, S4).
+    3.  Panggil Tool `predict_mining_target` dengan 4 skenario.
+    4.  **Struktur Output (WAJIB KETAT):** Jawaban akhir HARUS berupa objek JSON yang sesuai dengan skema output, tanpa teks lain.
+        a. Hitung hasil prediksi dan selisih mutlak dari TT untuk keempat skenario.
+        b. `initial_analysis_text`: Sajikan analisis Skenario Kontrol secara kompleks serta alasannya.
+        c. `target_tonnage`: Nilai TT. `initial_prediction`: Hasil Prediksi Kontrol. `initial_difference`: Selisih Mutlak Kontrol.
+        d. `recommendations`: 3 skenario terbaik (termasuk Kontrol jika itu yang terbaik) yang paling mendekati TT. Setiap rekomendasi berisi `title` (judul deskriptif, misal: 'Mengurangi Truk'), `trucks`, `excavators`, `operators`, `weather`, `predicted_tonnage`, `difference_from_target`, dan `rationale` (alasan mengapa ini efektif, bandingkan dengan kontrol atau TT).
+        e. Pastikan SEMUA field terisi; field angka diisi dengan **nilai numerik murni** (tanpa unit atau simbol).
+    """
+
+
+async def predict_mining_target(scenarios: List[List[Union[int, float]]]) -> str:
     """Tool yang dipanggil oleh Gemini Agent untuk mendapatkan prediksi tonase."""
     if loaded_model is None:
         return "ERROR: Model prediksi belum dimuat atau gagal dimuat."
@@ -51,18 +279,26 @@ def predict_mining_target(scenarios: List[List[Union[int, float]]]) -> str:
         return "ERROR: Input skenario kosong."
 
     try:
-        predictions = loaded_model.predict(scenarios)
-        
-        results = []
-        for i, (input_data, target) in enumerate(zip(scenarios, predictions)):
-            results.append({
-                "id": i + 1,
+        features = np.ascontiguousarray(scenarios, dtype=np.float64)
+        if fast_predict is not None:
+            # Hanya beberapa operasi numpy; lebih murah daripada berpindah ke thread pool.
+            raw_predictions = fast_predict(features)
+        else:
+            loop = asyncio.get_running_loop()
+            raw_predictions = await loop.run_in_executor(_predict_pool, loaded_model.predict, features)
+        predictions = np.round(raw_predictions, 2).tolist()
+
+        results = [
+            {
+                "id": i,
                 "trucks": input_data[0],
                 "excavators": input_data[1],
                 "operators": input_data[2],
                 "weather": input_data[3],
-                "predicted_tonnage": round(target, 2)
-            })
+                "predicted_tonnage": target
+            }
+            for i, (input_data, target) in enumerate(zip(scenarios, predictions), start=1)
+        ]
 
         return f"PREDICTION_RESULTS: {results}"
         
@@ -71,127 +307,101 @@ def predict_mining_target(scenarios: List[List[Union[int, float]]]) -> str:
 
 
 def initialize_agent():
-    """Menginisialisasi LlmAgent secara global dengan instruksi parsing yang ketat."""
-    global mining_agent
-    
-    agent_instruction = """
-    Anda adalah **Ahli Optimasi Sumber Daya Tambang** (Mining Data Analyst).
-
-    **Pemetaan Cuaca:** Light Rain=0, Cloudy=1, Sunny=2
-    
-    **ATURAN KONTEKS:**
-    1. Jika query baru adalah MODIFIKASI (misal: "tambah 2 truk"), Anda HARUS mengambil Target Tonase (TT), Truk (T), Ekskavator (E), Operator (O), dan Cuaca (C) dari riwayat percakapan terakhir dan menerapkan modifikasi tersebut.
-    2. Jika query baru memiliki SEMUA parameter, gunakan yang baru.
-
-    **Tugas Utama (Untuk Setiap Respon):**
-    1.  **Ekstrak/Tentukan** nilai: Target Tonase (TT), Truk (T), Ekskavator (E), Operator (O), dan Cuaca (C) dari query saat ini ATAU dari konteks yang dimodifikasi.
-    2.  Buat Skenario 1 (Kontrol: T, E, O, C) dan 3 Skenario modifikasi (S2, S3, S4).
-    3.  Panggil Tool `predict_mining_target` dengan 4 skenario.
-    4.  **Parsing dan Struktur Output (WAJIB KETAT):**
-        a. Hitung hasil prediksi dan selisih mutlak dari TT untuk keempat skenario.
-        b. **OUTPUT PART 1 (Analisis Awal):** Sajikan analisis Skenario Kontrol secara kompleks serta alasannya.
-        c. **OUTPUT PART 2 (Rekomendasi):** Sajikan 3 skenario terbaik (termasuk Kontrol jika itu yang terbaik) yang paling mendekati TT.
-        d. Gunakan format ketat berikut, pastikan SEMUA field terisi dengan **nilai numerik murni** (tanpa unit atau simbol kecuali titik desimal).
-
-    [Analisis singkat Skenario Kontrol]
-    Target_Tonase_Ekstrak: [Nilai TT, harus berupa angka]
-    Prediksi_Kontrol: [Hasil Prediksi Kontrol, harus berupa angka]
-    Selisih_Kontrol: [Selisih Mutlak Kontrol, harus berupa angka]
-    ---END_ANALYSIS---
-    
-    Rekomendasi 1: [Judul Deskriptif R1, misal: 'Mengurangi Truk']
-    Truk: [Nilai T]
-    Ekskavator: [Nilai E]
-    Operator: [Nilai O]
-    Cuaca: [Nilai C]
-    Prediksi: [Hasil Prediksi]
-    Selisih: [Selisih Mutlak]
-    Alasan: [Alasan mengapa ini efektif, bandingkan dengan kontrol atau TT]
-    ---START_RECOMMENDATION---
-    
-    Rekomendasi 2: [Judul Deskriptif R2]
-    Truk: [Nilai T]
-    Ekskavator: [Nilai E]
-    Operator: [Nilai O]
-    Cuaca: [Nilai C]
-    Prediksi: [Hasil Prediksi]
-    Selisih: [Selisih Mutlak]
-    Alasan: [Alasan mengapa ini efektif, bandingkan dengan kontrol atau TT]
-    ---START_RECOMMENDATION---
-    
-    Rekomendasi 3: [Judul Deskriptif R3]
-    Truk: [Nilai T]
-    Ekskavator: [Nilai E]
-    Operator: [Nilai O]
-    Cuaca: [Nilai C]
-    Prediksi: [Hasil Prediksi]
-    Selisih: [Selisih Mutlak]
-    Alasan: [Alasan mengapa ini efektif, bandingkan dengan kontrol atau TT]
-    """
+    """Menginisialisasi LlmAgent dan Runner secara global dengan instruksi parsing yang ketat."""
+    global mining_agent, runner
 
     mining_agent = LlmAgent(
         name=AGENT_NAME,
         model=GEMINI_MODEL,
         tools=[predict_mining_target], 
-        instruction=agent_instruction,
+        instruction=_AGENT_INSTRUCTION,
+        output_schema=ParsedRecommendationResponse,
         description="Memberikan analisis hasil input pengguna dan 3 rekomendasi konfigurasi alat berat terbaik untuk mencapai target produksi harian.",
     )
+    runner = Runner(agent=mining_agent, app_name=APP_NAME, session_service=session_service)
     print("SUCCESS: Gemini Agent berhasil diinisialisasi.")
     
 initialize_agent() 
 
 
-class RecommendationDetail(BaseModel):
-    title: str = Field(..., description="Judul deskriptif rekomendasi.")
-    trucks: int
-    excavators: int
-    operators: int
-    weather: Union[int, str]
-    predicted_tonnage: float
-    difference_from_target: float
-    rationale: str = Field(..., description="Alasan kuat dan berbasis data mengapa skenario ini direkomendasikan.")
+def _leading_number(value: str) -> str:
+    """Mengambil angka di awal nilai (digit dan titik desimal), misal '80 ton' -> '80'."""
+    value = value.strip()
+    end = 0
+    while end < len(value) and value[end] in '0123456789.':
+        end += 1
+    return value[:end]
 
-class MiningInput(BaseModel):
-    """Schema untuk data yang dikirimkan: pesan teks bebas."""
-    user_id: str = Field(..., example="user_api_001", description="ID unik pengguna untuk sesi berlanjut.")
-    query: str = Field(..., example="Saya ingin 80 ton. Saat ini pakai 12 Truk, 3 Ekskavator, 18 Operator, cuaca Cloudy. Beri 3 rekomendasi!", description="Pesan teks bebas yang berisi Target dan parameter tambang.")
-
-class ParsedRecommendationResponse(BaseModel):
-    """Schema untuk output yang sudah dipisah-pisah. Semua kolom penting WAJIB diisi."""
-    status: str = Field("success")
-    target_tonnage: int = Field(..., description="Target tonase yang diekstrak.") 
-    initial_analysis_text: str = Field(..., description="Analisis Agent mengenai Skenario Kontrol (Input Asli).")
-    initial_prediction: float = Field(..., description="Hasil prediksi tonase dari input asli.") 
-    initial_difference: float = Field(..., description="Selisih mutlak dari input asli ke target.") 
-    recommendations: List[RecommendationDetail] = Field(..., description="Daftar 3 skenario rekomendasi terbaik.")
 
+def _take_analysis_numbers(line: str, numbers: Dict[str, str]) -> str:
+    """
+    Mengambil setiap pasangan 'Key: angka' dari _ANALYSIS_KEYS pada satu baris (bisa lebih dari satu per baris)
+    ke dalam numbers, lalu mengembalikan sisa teks baris tanpa pasangan tersebut.
+    """
+    for key in _ANALYSIS_KEYS:
+        start = line.find(key)
+        while start >= 0:
+            pos = start + len(key)
+            while pos < len(line) and line[pos] == '*':
+                pos += 1
+            if pos < len(line) and line[pos] == ':':
+                pos += 1
+                while pos < len(line) and line[pos] in ' \t*':
+                    pos += 1
+                number = _leading_number(line[pos:])
+                if number:
+                    numbers.setdefault(key, number)
+                    line = line[:start] + line[pos + len(number):]
+                    break
+            # Kemunculan ini bukan pasangan 'Key: angka' (misal key disebut dalam kalimat); cari berikutnya.
+            start = line.find(key, start + 1)
+    return line
 
 
 def parse_agent_response(text: str) -> Dict[str, Union[str, float, int, List[Dict]]]:
     """
     Mengurai respons teks Agent yang memiliki format ketat menjadi struktur data Python.
-    Memastikan semua field numerik dan alasan terisi.
+    Hasil disimpan di LRU cache berdasarkan teks respons, sehingga output Agent yang sama tidak diurai ulang.
     """
+    cached = _parse_cache.get(text)
+    if cached is not None:
+        return cached
+
+    result = _parse_agent_response(text)
+    _parse_cache[text] = result
+    return result
+
+
+def _parse_agent_response(text: str) -> Dict[str, Union[str, float, int, List[Dict]]]:
+    """Implementasi parse_agent_response tanpa cache. Memastikan semua field numerik dan alasan terisi."""
     
-    if '---END_ANALYSIS---' not in text:
+    end_idx = text.find(_END_ANALYSIS_TAG)
+    if end_idx < 0:
         return {"error": "Format respons Agent tidak valid: Tag END_ANALYSIS tidak ditemukan."}
 
-    analysis_part, recs_raw = text.split('---END_ANALYSIS---', 1)
+    analysis_part = text[:end_idx]
+    recs_raw = text[end_idx + len(_END_ANALYSIS_TAG):]
 
-    target_match = re.search(r'Target_Tonase_Ekstrak:\s*([\d\.]+)', analysis_part)
-    pred_match = re.search(r'Prediksi_Kontrol:\s*([\d\.]+)', analysis_part)
-    diff_match = re.search(r'Selisih_Kontrol:\s*([\d\.]+)', analysis_part)
+    numbers = {}
+    analysis_lines = []
+    for line in analysis_part.splitlines():
+        if ':' in line:
+            remainder = _take_analysis_numbers(line, numbers)
+            if remainder != line and not remainder.strip(' ,;*-'):
+                continue
+            line = remainder
+        analysis_lines.append(line)
 
     try:
-        initial_prediction = float(pred_match.group(1)) if pred_match else 0.0
-        target_tonnage = int(float(target_match.group(1))) if target_match else 0
-        initial_difference = float(diff_match.group(1)) if diff_match else 0.0
+        initial_prediction = float(numbers['Prediksi_Kontrol']) if 'Prediksi_Kontrol' in numbers else 0.0
+        target_tonnage = int(float(numbers['Target_Tonase_Ekstrak'])) if 'Target_Tonase_Ekstrak' in numbers else 0
+        initial_difference = float(numbers['Selisih_Kontrol']) if 'Selisih_Kontrol' in numbers else 0.0
     except Exception as e:
         return {"error": f"Gagal mengurai nilai numerik dari analisis awal. Error: {e}"}
 
-    analysis_text = re.sub(r'(Target_Tonase_Ekstrak|Prediksi_Kontrol|Selisih_Kontrol):\s*[\d\.]+', '', analysis_part).strip()
+    analysis_text = "\n".join(analysis_lines).strip()
 
-    recs_list = recs_raw.split('---START_RECOMMENDATION---')
+    recs_list = recs_raw.split(_RECOMMENDATION_TAG)
     recommendations_data = []
 
     for rec_block in recs_list:
@@ -200,32 +410,33 @@ def parse_agent_response(text: str) -> Dict[str, Union[str, float, int, List[Dic
             continue
 
         data = {}
-
-        title_match = re.search(r'Rekomendasi \d: (.*)', rec_block)
-        data['title'] = title_match.group(1).strip() if title_match else "Rekomendasi Tanpa Judul"
-
-        params = re.findall(r'(Truk|Ekskavator|Operator|Cuaca|Prediksi|Selisih|Alasan):\s*([^\n]+)', rec_block)
-        
-        mapping = {
-            'Truk': 'trucks', 'Ekskavator': 'excavators', 'Operator': 'operators', 
-            'Cuaca': 'weather', 'Prediksi': 'predicted_tonnage', 
-            'Selisih': 'difference_from_target', 'Alasan': 'rationale'
-        }
-        
-        for key, value in params:
-            python_key = mapping.get(key)
-            if python_key:
-                cleaned_value = value.replace('Ton', '').replace(',', '').strip()
-                try:
-                    if python_key in ['trucks', 'excavators', 'operators']:
-                        data[python_key] = int(float(cleaned_value)) 
-                    elif python_key in ['predicted_tonnage', 'difference_from_target']:
-                        data[python_key] = float(cleaned_value)
-                    else:
-                        data[python_key] = cleaned_value
-                except ValueError:
-                    data[python_key] = cleaned_value
-                    
+        has_title = 'Rekomendasi' in rec_block
+
+        for line in rec_block.splitlines():
+            key, sep, value = line.partition(':')
+            if not sep:
+                continue
+            key = key.strip(' *-')
+            value = value.strip(' *')
+            if not value:
+                continue
+
+            if has_title and key.startswith('Rekomendasi '):
+                data.setdefault('title', value)
+                continue
+
+            field = _REC_FIELDS.get(key)
+            if field is None:
+                continue
+
+            python_key, convert = field
+            cleaned_value = value.replace('Ton', '').replace(',', '').strip()
+            try:
+                data[python_key] = convert(cleaned_value)
+            except ValueError:
+                data[python_key] = cleaned_value
+
+        data.setdefault('title', "Rekomendasi Tanpa Judul")
         if 'rationale' not in data:
             data['rationale'] = "Alasan tidak tersedia (Gagal parsing)."
 
@@ -244,6 +455,41 @@ def parse_agent_response(text: str) -> Dict[str, Union[str, float, int, List[Dic
     }
 
 
+async def _run_agent(user_id: str, session_id: str, message: str) -> str:
+    """Mengirim satu pesan ke Agent pada sesi user dan mengembalikan teks respons akhirnya."""
+    response_chunks: List[str] = []
+    async for event in runner.run_async(
+        user_id=user_id, 
+        session_id=session_id, 
+        new_message=types.Content(role="user", parts=[types.Part(text=message)])
+    ):
+        if event.is_final_response() and event.content and event.content.parts:
+            for part in event.content.parts:
+                if part.text:
+                    response_chunks.append(part.text)
+                    break 
+
+    final_response_text = "".join(response_chunks)
+    if not final_response_text:
+        raise Exception("Agent tidak menghasilkan respons akhir yang valid.")
+    return final_response_text
+
+
+def _build_response(text: str) -> Dict:
+    """
+    Men-decode dan memvalidasi output JSON Agent menjadi dict sesuai ParsedRecommendationResponse.
+    Respons dengan format teks lama (tag END_ANALYSIS) tetap diurai lewat parse_agent_response.
+    Melempar ValueError atau msgspec.DecodeError jika output tidak valid.
+    """
+    if _END_ANALYSIS_TAG in text:
+        parsed_data = parse_agent_response(text)
+        if "error" in parsed_data:
+            raise ValueError(parsed_data['error'])
+        return ParsedRecommendationResponse(status="success", **parsed_data).model_dump()
+
+    return msgspec.to_builtins(_AGENT_OUTPUT_DECODER.decode(text))
+
+
 @app.post("/predict_and_recommend", response_model=ParsedRecommendationResponse)
 async def predict_and_recommend(data: MiningInput):
     """
@@ -252,7 +498,7 @@ async def predict_and_recommend(data: MiningInput):
     """
     global mining_agent
 
-    if mining_agent is None or os.getenv("GEMINI_API_KEY") is None:
+    if mining_agent is None or runner is None or os.getenv("GEMINI_API_KEY") is None:
         raise HTTPException(
             status_code=503, 
             detail="Layanan Agent atau Kunci API tidak tersedia."
@@ -262,42 +508,30 @@ async def predict_and_recommend(data: MiningInput):
     user_id = data.user_id 
     session_id = f"session_{user_id}" 
 
-    try:
-        await session_service.create_session(app_name=APP_NAME, user_id=user_id, session_id=session_id)
-    except Exception:
-        pass
+    if not await session_service.has_session(app_name=APP_NAME, user_id=user_id, session_id=session_id):
+        try:
+            await session_service.create_session(app_name=APP_NAME, user_id=user_id, session_id=session_id)
+        except Exception:
+            pass
 
-    runner = Runner(agent=mining_agent, app_name=APP_NAME, session_service=session_service)
-
-    final_response_text = ""
     try:
-        async for event in runner.run_async(
-            user_id=user_id, 
-            session_id=session_id, 
-            new_message=types.Content(role="user", parts=[types.Part(text=query)])
-        ):
-            if event.is_final_response() and event.content and event.content.parts:
-                for part in event.content.parts:
-                    if part.text:
-                        final_response_text += part.text
-                        break 
-        
-        if not final_response_text:
-              raise Exception("Agent tidak menghasilkan respons akhir yang valid.")
-
-        parsed_data = parse_agent_response(final_response_text)
-        
-        if "error" in parsed_data:
-              raise Exception(f"Gagal mem-parsing output Agent: {parsed_data['error']}")
-
-        return ParsedRecommendationResponse(
-            status="success",
-            target_tonnage=parsed_data['target_tonnage'],
-            initial_analysis_text=parsed_data['initial_analysis_text'],
-            initial_prediction=parsed_data['initial_prediction'],
-            initial_difference=parsed_data['initial_difference'],
-            recommendations=parsed_data['recommendations']
-        )
+        final_response_text = await _run_agent(user_id, session_id, query)
+
+        for attempt in range(_MAX_OUTPUT_RETRIES + 1):
+            try:
+                content = _build_response(final_response_text)
+                break
+            except (ValueError, msgspec.DecodeError) as e:
+                if attempt == _MAX_OUTPUT_RETRIES:
+                    raise Exception(f"Gagal mem-parsing output Agent: {e}")
+                final_response_text = await _run_agent(
+                    user_id,
+                    session_id,
+                    f"Output sebelumnya tidak sesuai skema: {e}\nKirim ulang jawaban lengkap sebagai JSON yang sesuai skema output."
+                )
+
+        # FastAPI memvalidasi dan menserialisasi content langsung lewat Pydantic sesuai response_model.
+        return content
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Kesalahan pada layanan Agent: {str(e)}")
@@ -307,8 +541,8 @@ async def predict_and_recommend(data: MiningInput):
 async def end_session(user_id: str):
     """Menghapus sesi Agent berdasarkan user_id, memaksa sesi baru di permintaan berikutnya."""
     session_id = f"session_{user_id}"
-    try:
-        await session_service.delete_session(app_name=APP_NAME, user_id=user_id, session_id=session_id)
-        return {"status": "success", "message": f"Sesi untuk user_id '{user_id}' berhasil diakhiri."}
-    except Exception:
-        return {"status": "info", "message": f"Sesi untuk user_id '{user_id}' tidak ditemukan atau sudah berakhir."}
\ No newline at end of file
+    if not await session_service.has_session(app_name=APP_NAME, user_id=user_id, session_id=session_id):
+        return {"status": "info", "message": f"Sesi untuk user_id '{user_id}' tidak ditemukan atau sudah berakhir."}
+
+    await session_service.delete_session(app_name=APP_NAME, user_id=user_id, session_id=session_id)
+    return {"status": "success", "message": f"Sesi untuk user_id '{user_id}' berhasil diakhiri."}
@@ -1,8 +1,8 @@
 import asyncio
 import os 
-import pickle 
 import re 
 from dotenv import load_dotenv 
+from joblib import load as joblib_load
 from typing import List, Dict, Union, Optional
 
 # --- Library FastAPI dan Pydantic ---
@@ -34,8 +34,7 @@ MODEL_FILE = 'model.pkl'
 loaded_model = None
 
 try:
-    with open(MODEL_FILE, 'rb') as file:
-        loaded_model = pickle.load(file)
+    loaded_model = joblib_load(MODEL_FILE)
     print(f"SUCCESS: Model '{MODEL_FILE}' berhasil dimuat.")
 except FileNotFoundError:
     print(f"ERROR: File '{MODEL_FILE}' tidak ditemukan. Model prediksi tidak akan berfungsi.")
@@ -0,0 +1,34 @@
+import os
+
+import joblib
+
+MODEL_FILE = 'model.pkl'
+
+# Skrip satu kali: menyimpan ulang model pickle biasa dalam format joblib
+# agar agent.py dapat memuatnya dengan joblib.load(..., mmap_mode='r').
+
+if not os.path.exists(MODEL_FILE):
+    print(f"ERROR: File '{MODEL_FILE}' tidak ditemukan di direktori ini.")
+    exit()
+
+try:
+    # joblib.load membaca pickle biasa maupun format joblib, jadi skrip aman dijalankan ulang.
+    model = joblib.load(MODEL_FILE)
+    print(f"SUCCESS: Model '{MODEL_FILE}' berhasil dimuat!")
+except Exception as e:
+    print(f"ERROR saat memuat model: {e}")
+    exit()
+
+# Tulis ke file sementara dulu; model.pkl asli baru diganti setelah dump selesai dan bisa dimuat ulang.
+tmp_file = f"{MODEL_FILE}.tmp"
+try:
+    joblib.dump(model, tmp_file)
+    joblib.load(tmp_file, mmap_mode='r')
+    os.replace(tmp_file, MODEL_FILE)
+except Exception as e:
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    print(f"ERROR saat menyimpan model: {e}. File '{MODEL_FILE}' tidak diubah.")
+    exit()
+
+print(f"SUCCESS: Model disimpan ulang ke '{MODEL_FILE}' dalam format joblib.")
@@ -1,6 +1,7 @@
-import pickle
 import os
 
+import joblib
+
 MODEL_FILE = 'model.pkl'
 
 if not os.path.exists(MODEL_FILE):
@@ -8,8 +9,7 @@ if not os.path.exists(MODEL_FILE):
     exit()
 
 try:
-    with open(MODEL_FILE, 'rb') as file:
-        loaded_model = pickle.load(file)
+    loaded_model = joblib.load(MODEL_FILE)
     print(f"SUCCESS: Model '{MODEL_FILE}' berhasil dimuat!")
 except Exception as e:
     print(f"ERROR saat memuat model: {e}")